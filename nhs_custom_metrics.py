@@ -12,9 +12,14 @@ from datetime import datetime
 from csv import DictReader, DictWriter
 from json import dump 
 from itertools import chain
+from functools import partial
+from difflib import get_close_matches
+from queue import Queue
+from threading import Thread, Lock
+from time import time
 from exceptions.nhs_exceptions import *
 from log.nhs_proknow_log import NHSProKnowLog
-import os, errno
+import os, errno, re
 
 class NHSProKnow(): 
     ''' 
@@ -118,6 +123,156 @@ class NHSCustomMetric():
             )
             
 
+class NHSPipeline():
+    '''
+    Script object for running a staged producer/consumer pipeline. 
+
+    Each stage has its own pool of worker threads and reads from a bounded 
+    queue fed by the previous stage, so network reads for later items 
+    overlap with writes for earlier ones and memory stays bounded. 
+
+    Params: 
+        • stages 
+            list of (name, func, workers) or (name, func, workers, describe)
+            tuples. 
+            The first func takes no arguments, subsequent funcs take one 
+            item from the previous stage. 
+            Each func returns an iterable of items for the next stage. 
+            describe (optional) takes an item and returns a str naming it 
+            in the log if func fails. 
+        • queue_size: int 
+            maximum number of items waiting between two stages 
+        • log_lines: list (optional)
+            errors are appended here rather than stopping the pipeline 
+
+    Methods: 
+        • run
+        • report
+            returns a list of strs, per-stage queue depth and throughput 
+    '''
+    _STOP = object()
+
+    def __init__(self, stages: list, queue_size: int = 32, 
+        log_lines: list = None):
+
+        self.queue_size = queue_size
+        self.log_lines = log_lines if log_lines is not None else []
+        self._lock = Lock()
+
+        self.stages = []
+        in_q = None
+        for i, (name, func, workers, *describe) in enumerate(stages):
+            out_q = Queue(maxsize = queue_size) if i < len(stages) - 1 else None
+            self.stages.append({
+                "name": name, 
+                "func": func, 
+                "describe": describe[0] if describe else None, 
+                "workers": max(1, workers) if in_q else 1,
+                "in_q": in_q, 
+                "out_q": out_q,
+                "live": 0,
+                "processed": 0, 
+                "failed": 0, 
+                "emitted": 0, 
+                "depth_total": 0, 
+                "depth_max": 0, 
+                "elapsed": 0.0,
+            })
+            in_q = out_q
+
+    def run(self):
+        threads = []
+        start = time()
+        for i, stage in enumerate(self.stages):
+            stage["live"] = stage["workers"]
+            for _ in range(stage["workers"]):
+                threads.append(Thread(
+                    target = self._worker, args = (i, start), daemon = True
+                ))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _worker(self, i: int, start: float):
+        stage = self.stages[i]
+
+        if stage["in_q"] is None:
+            self._process(stage, None)
+        else:
+            while True:
+                depth = stage["in_q"].qsize()
+                item = stage["in_q"].get()
+                if item is self._STOP:
+                    break
+                with self._lock:
+                    stage["depth_total"] += depth
+                    stage["depth_max"] = max(stage["depth_max"], depth)
+                self._process(stage, item)
+
+        with self._lock:
+            stage["live"] -= 1
+            last = stage["live"] == 0
+            if last:
+                stage["elapsed"] = time() - start
+
+        # last worker out tells every worker in the next stage to stop 
+        if last and stage["out_q"] is not None:
+            for _ in range(self.stages[i + 1]["workers"]):
+                stage["out_q"].put(self._STOP)
+
+    def _process(self, stage: dict, item):
+        try:
+            if stage["in_q"] is None:
+                results = stage["func"]()
+            else:
+                results = stage["func"](item)
+            for result in results:
+                if stage["out_q"] is not None:
+                    stage["out_q"].put(result)
+                    with self._lock:
+                        stage["emitted"] += 1
+            ok = True
+        except Exception as e:
+            ok = False
+            if stage["describe"] is not None and item is not None:
+                name = f"{self._describe(stage, item)} \n"
+            else:
+                name = ""
+            self.log_lines.append(
+                f"ERROR! {stage['name']} stage \n{name}{type(e).__name__}: {e}"
+            )
+        with self._lock:
+            stage["processed" if ok else "failed"] += 1
+
+    def _describe(self, stage: dict, item) -> str:
+        try:
+            return stage["describe"](item)
+        except Exception:
+            return repr(item)
+
+    def report(self) -> list:
+        lines = []
+        for stage in self.stages:
+            n = stage["processed"] + stage["failed"]
+            # the first stage has no inbound items, so rate it on what it emits
+            rate_n = n if stage["in_q"] is not None else stage["emitted"]
+            rate = rate_n / stage["elapsed"] if stage["elapsed"] else 0.0
+            line = (
+                f"{stage['name']}: {stage['workers']} worker(s), "
+                f"{stage['processed']} ok, {stage['failed']} failed, "
+                f"{stage['emitted']} out, {rate:.2f} items/s"
+            )
+            if stage["in_q"] is not None:
+                mean_depth = stage["depth_total"] / n if n else 0.0
+                line += (
+                    f", queue depth mean {mean_depth:.1f} "
+                    f"max {stage['depth_max']}/{self.queue_size}"
+                )
+            lines.append(line)
+        return lines
+
+
 class NHSCustomMetricsFromCSV(NHSProKnow):
     '''
     Script object template for adding Custom Metric values to patient entities, 
@@ -131,12 +286,16 @@ class NHSCustomMetricsFromCSV(NHSProKnow):
         log_lines
             list of strs.
             For logging. 
+        unresolved
+            list of dicts.
+            Rows that were ambiguous, a near miss or not found. 
         
     Methods:
         add_cms_from_csv
             Only contexts of patient, image_set, structure_set, dose, plan
             are supported. 
-            Finds entities with exactly matching type and description. 
+            Fetches each patient's entities once and matches on type and 
+            description, ignoring case, whitespace and punctuation. 
         write_logs
 
     '''
@@ -153,6 +312,7 @@ class NHSCustomMetricsFromCSV(NHSProKnow):
             )
 
         self.log_lines = []
+        self.unresolved = []
 
     def write_logs(self, log_path = None):
         logger = NHSProKnowLog(
@@ -160,15 +320,104 @@ class NHSCustomMetricsFromCSV(NHSProKnow):
             log_lines = self.log_lines
         )
 
-    def _update_meta(self, entity, cm: dict):
+    @staticmethod
+    def _normalise(text: str) -> str:
         '''
-        Update entity metadata. 
+        Lower case, with whitespace and punctuation removed. 
         '''
-        meta = entity.get_metadata()
-        if "string" in self.pk.custom_metrics.resolve(cm["CustomMetricName"]).type:
-            meta[cm["CustomMetricName"]] = cm["Value"]
+        return re.sub(r"[\W_]+", "", str(text or "").lower())
+
+    def _index_key(self, context: str, description: str) -> tuple:
+        '''
+        Descriptions made only of whitespace or punctuation normalise to ""
+        so they keep their raw text and only match exactly. 
+        '''
+        description = str(description or "")
+        return (context, self._normalise(description) or description)
+
+    def _index_entities(self, patient) -> dict:
+        '''
+        Params: 
+            patient: ProKnow patient object. 
+
+        Returns:
+            dict of (context, normalised description) -> list of 
+            (description, entity summary) tuples, from a single pass over 
+            the patient's entities. 
+        '''
+        index = {}
+        for entity_summary in patient.find_entities(lambda entity: True):
+            description = entity_summary.data.get("description")
+            key = self._index_key(entity_summary.data["type"], description)
+            index.setdefault(key, []).append((description, entity_summary))
+        return index
+
+    def _resolve(self, index: dict, cm: dict):
+        '''
+        Params: 
+            index: dict, see _index_entities 
+            cm: dict, a row from the csv 
+
+        Returns:
+            (entity summary, None) on a unique match, otherwise 
+            (None, problem) where problem is a dict for the unresolved report. 
+            Where several entities normalise the same, a single exact 
+            description match still wins. 
+        '''
+        key = self._index_key(cm["Context"], cm["Description"])
+        matches = index.get(key, [])
+
+        if len(matches) == 1:
+            return matches[0][1], None
+
+        exact = [
+            summary for description, summary in matches 
+            if description == cm["Description"]
+        ]
+        if len(exact) == 1:
+            return exact[0], None
+
+        if matches:
+            problem = "Ambiguous"
+            candidates = [description for description, summary in matches]
         else:
-            meta[cm["CustomMetricName"]] = float(cm["Value"])
+            problem = "Not found"
+            descriptions = {
+                desc: [description for description, summary in ms] 
+                for (context, desc), ms in index.items() 
+                if context == cm["Context"] and self._normalise(desc)
+            }
+            close = get_close_matches(key[1], descriptions.keys(), n=3, cutoff=0.8)
+            if close:
+                problem = "Near miss"
+            candidates = list(chain(*[descriptions[c] for c in close]))
+
+        return None, self._problem(cm, problem, candidates)
+
+    @staticmethod
+    def _problem(cm: dict, problem: str, candidates: list = None) -> dict:
+        '''
+        A row for the unresolved report. 
+        '''
+        return {
+            "PatientID": cm["PatientID"],
+            "CustomMetricName": cm["CustomMetricName"],
+            "Context": cm["Context"],
+            "Description": cm["Description"],
+            "Problem": problem,
+            "Candidates": " | ".join(candidates or [])
+        }
+
+    def _update_meta(self, entity, cms: list):
+        '''
+        Update entity metadata with all CMs for the entity, then save once. 
+        '''
+        meta = entity.get_metadata()
+        for cm in cms:
+            if "string" in self.pk.custom_metrics.resolve(cm["CustomMetricName"]).type:
+                meta[cm["CustomMetricName"]] = cm["Value"]
+            else:
+                meta[cm["CustomMetricName"]] = float(cm["Value"])
         entity.set_metadata(meta)
         entity.save()
 
@@ -178,80 +427,114 @@ class NHSCustomMetricsFromCSV(NHSProKnow):
         self._cms = [
             NHSCustomMetric(cm, self.pk) for cm in self.csv
         ]
+        self.unresolved = []
 
-        print("Adding Custom Metric values to entities from csv...")
-        with ChargingBar('Processing CMs: ', max = len(self._cms)) as bar:
-            for nhs_cm in self._cms: 
-
-                self.log_lines.append(
-                    nhs_cm.check_result
-                )
+        for nhs_cm in self._cms:
+            self.log_lines.append(
+                nhs_cm.check_result
+            )
+            self.log_lines.append(
+                nhs_cm.create_result
+            )
 
-                self.log_lines.append(
-                    nhs_cm.create_result
-                )
+        # one lookup, one get and one entity index per patient 
+        rows_by_patient = {}
+        for nhs_cm in self._cms:
+            cm = nhs_cm.custom_metric
+            rows_by_patient.setdefault(cm["PatientID"], []).append(cm)
 
-                cm = nhs_cm.custom_metric
+        print("Adding Custom Metric values to entities from csv...")
+        with ChargingBar('Processing CMs: ', max = len(self._cms)) as bar:
+            for patient_id, cms in rows_by_patient.items(): 
 
                 patients = self.pk.patients.lookup(
-                    self.ws, [cm['PatientID']]
+                    self.ws, [patient_id]
                     )
 
-                if len(patients) > 1:
-                    # raise PatientIDNotUniqueError(cm['PatientID'])
+                # lookup returns one slot per MRN, None where it is missing 
+                if patients[0] is None:
+                    for cm in cms:
+                        self.unresolved.append(
+                            self._problem(cm, "Patient not found")
+                        )
+                        self.log_lines.append(
+                            f"ERROR! \n PatientID: {patient_id} not found. \n"
+                            f"No further processing on {cm['CustomMetricName']}"
+                        )
+                        bar.next()
                     self.log_lines.append(
-                        f"ERROR! \n PatientID: {cm['PatientID']} not unique. \n"
-                        f"No further processing on {cm['CustomMetricName']}"
+                        " ----------------------------------------------------------------------- "
                     )
+                    continue
 
-                else:
-                    patient = patients[0].get()
+                patient = patients[0].get()
 
+                # entity id -> (entity summary or patient, list of cms)
+                targets = {}
+                if any(cm["Context"] != "patient" for cm in cms):
+                    index = self._index_entities(patient)
+
+                for cm in cms:
                     if cm["Context"] == "patient":
-                        self._update_meta(
-                            patient, 
-                            cm
-                        )
-                        self.log_lines.append(
-                                f"SUCCESS! {cm['PatientID']} \n"
-                                f"{cm['CustomMetricName']} with value: {cm['Value']} added."
-                            )
+                        targets.setdefault(patient.id, (patient, []))[1].append(cm)
+                        continue
 
-                    else:
-                        entities = patient.find_entities(
-                            type=cm["Context"],
-                            description = cm['Description']
+                    entity_summary, problem = self._resolve(index, cm)
+                    if problem:
+                        self.unresolved.append(problem)
+                        self.log_lines.append(
+                            f"ERROR! {cm['PatientID']} \n"
+                            f"{problem['Problem']}: {cm['Context']} with "
+                            f"description: {cm['Description']} \n"
+                            f"Candidates: {problem['Candidates'] or 'None'}"
                         )
+                        bar.next()
+                    else:
+                        targets.setdefault(
+                            entity_summary.id, (entity_summary, [])
+                        )[1].append(cm)
 
-                        if not entities: 
-                            # raise EntityNotFoundError
-                            self.log_lines.append(
-                                f"ERROR! {cm['PatientID']} \n"
-                                f"No {cm['Context']} with description: {cm['Description']}"
+                for entity, entity_cms in targets.values():
+                    try:
+                        if entity is not patient:
+                            entity = entity.get()
+                        self._update_meta(entity, entity_cms)
+                    except Exception as e:
+                        for cm in entity_cms:
+                            self.unresolved.append(
+                                self._problem(cm, "Update failed")
                             )
-
-                        elif len(entities) > 1:
                             self.log_lines.append(
                                 f"ERROR! {cm['PatientID']} \n"
-                                f"{cm['Context']} with description: {cm['Description']} "
-                                "is not unique!"
+                                f"Update failed: {cm['Context']} with "
+                                f"description: {cm['Description']} \n"
+                                f"{cm['CustomMetricName']} with value: {cm['Value']} "
+                                f"not added. {type(e).__name__}: {e}"
                             )
+                            bar.next()
+                        continue
+
+                    for cm in entity_cms:
+                        self.log_lines.append(
+                            f"SUCCESS! {cm['PatientID']} \n"
+                            f"{cm['CustomMetricName']} with value: {cm['Value']} added."
+                        )
+                        bar.next()
 
-                        else: 
-                            ent = entities[0].get()     
-                            self._update_meta(
-                                ent,
-                                cm
-                            )
-                            self.log_lines.append(
-                                f"SUCCESS! {cm['PatientID']} \n"
-                                f"{cm['CustomMetricName']} with value: {cm['Value']} added."
-                            )
                 self.log_lines.append(
                     " ----------------------------------------------------------------------- "
                 )
-                bar.next()
         print("Done!")
+        if self.unresolved:
+            problems = [p["Problem"] for p in self.unresolved]
+            summary = f"{len(self.unresolved)} row(s) not resolved: " + ", ".join(
+                f"{problems.count(problem)} {problem.lower()}" for problem in [
+                    "Patient not found", "Ambiguous", "Near miss", "Not found", 
+                    "Update failed"
+                ]
+            ) + "."
+            print(summary)
+            self.log_lines.append(summary)
         self.write_logs() 
 
 class NHSCustomMetricsFromDICOM(NHSProKnow):
@@ -265,10 +548,16 @@ class NHSCustomMetricsFromDICOM(NHSProKnow):
     Attributes:
         • collection: str
         • collection_patients: list 
-        • log_lines: list of dicts 
+        • log_lines: list of strs 
+        • pipeline: NHSPipeline 
+            the most recent run, see NHSPipeline.report 
 
     Methods: 
         • write_all_custom_metrics
+            Runs as a staged pipeline: patient enumeration, entity fetch,
+            metric computation, metadata write. Each stage has its own 
+            worker count and a bounded queue. 
+        • write_logs
     '''
     def __init__(self, collection: str = 'My Collection', **kwargs):
         super().__init__(**kwargs)
@@ -276,6 +565,7 @@ class NHSCustomMetricsFromDICOM(NHSProKnow):
 
         collection_item = self.pk.collections.find(workspace = self.ws, name=self.collection).get()
         self.collection_patients = collection_item.patients.query()
+        self.log_lines = []
 
         # TO-DO read this from file 
         self.nhs_custom_metrics = [
@@ -299,111 +589,210 @@ class NHSCustomMetricsFromDICOM(NHSProKnow):
             }
             NHSCustomMetric(dict_cm, self.pk)
 
-    def write_all_custom_metrics(self):
+    def write_logs(self, log_path = None):
+        logger = NHSProKnowLog(
+            log_path = log_path,
+            log_lines = self.log_lines
+        )
 
-        print(
-            "Writing *NHSCustomMetrics for patients in "
-            f"{self.collection}."
-            )
+    @staticmethod
+    def _describe_patient(patient) -> str:
+        return f"PatientID: {patient.data.get('mrn', patient.id)}"
 
-        with ChargingBar('Processing Patients: ', 
-        max=len(self.collection_patients)) as bar:
-            for patient in self.collection_patients:
-                px = self.pk.patients.find(workspace = self.ws, id=patient.id).get()
-                if px.birth_date:
-                    dob = datetime.strptime(px.birth_date, '%Y-%m-%d') 
-                else:
-                    dob = None
-
-                # TO-DO 
-                    # logs 
-                    # leap years - Age at imaging?
-                    # dose?
-
-                # IMAGE SETS 
-                if dob:
-                    for image_entity in px.find_entities(type="image_set"):
+    @staticmethod
+    def _describe_entity(entity) -> str:
+        '''
+        Works for entity summaries and entity items. 
+        '''
+        return (
+            f"{entity.data.get('type')} {entity.id} with description: "
+            f"{entity.data.get('description')}"
+        )
+
+    def _enumerate_patients(self):
+        '''
+        Pipeline stage 1: yields PatientSummary items in the collection. 
+        '''
+        for patient in self.collection_patients:
+            yield patient
+
+    def _fetch_entities(self, patient, bar, bar_lock):
+        '''
+        Pipeline stage 2: fetches the patient and the entities we need.
+        Yields (context, entity, extra) tuples where extra is the 
+        date of birth for image sets and the delivery information for plans. 
+        A failing entity is logged and the rest of the patient carries on. 
+        '''
+        try:
+            px = self.pk.patients.find(workspace = self.ws, id=patient.id).get()
+            if px.birth_date:
+                dob = datetime.strptime(px.birth_date, '%Y-%m-%d') 
+            else:
+                dob = None
+
+            # TO-DO 
+                # leap years - Age at imaging?
+                # dose?
+
+            # IMAGE SETS 
+            if dob:
+                for image_entity in px.find_entities(type="image_set"):
+                    try:
                         entity = image_entity.get()
-                        if entity.data['series']['date']: 
-                            series_date = datetime.strptime(
-                                entity.data['series']['date'],
-                                '%Y-%m-%d'
-                            )
-                            image_age = (series_date - dob).days//364.2425
-                            meta = {
-                                    "*NHS - Approx. age at imaging [years]": image_age
-                            }
-                            meta = {**entity.get_metadata(), **meta}
-                            entity.set_metadata(meta)
-                            entity.save()
-
-                # PLANS
-                for plan_entity in px.find_entities(type="plan"):
+                    except Exception as e:
+                        self._log_fetch_error(patient, image_entity, e)
+                        continue
+                    yield ("image_set", entity, dob)
+
+            # PLANS
+            for plan_entity in px.find_entities(type="plan"):
+                try:
                     entity = plan_entity.get()
                     del_info = entity.get_delivery_information()
+                except Exception as e:
+                    self._log_fetch_error(patient, plan_entity, e)
+                    continue
+                yield ("plan", entity, del_info)
+
+        finally:
+            with bar_lock:
+                bar.next()
 
-                    equipment = del_info['equipment'] 
+    def _log_fetch_error(self, patient, entity, e):
+        self.log_lines.append(
+            f"ERROR! Fetch stage \n{self._describe_patient(patient)} "
+            f"{self._describe_entity(entity)} \n{type(e).__name__}: {e}"
+        )
 
-                    total_fractions = sum(
-                        [fg['number_of_fractions_planned'] for fg in del_info['fraction_groups']]
-                    ) 
-                    beams = del_info['beams']
+    def _compute_metrics(self, item):
+        '''
+        Pipeline stage 3: computes the *NHS custom metric values. 
+        Yields (entity, meta) tuples. 
+        '''
+        context, entity, extra = item
 
-                    technique = " ".join( item for item  in {
-                        " ".join([
-                            beam['delivery_modality'],
-                            beam['radiation_type'],
-                            beam['delivery_modality'],
-                            f"IMRT: {beam['is_modulated']}",
-                            f"Helical: {beam['is_helical']}",
-                            ])
-                        for beam in beams
-                    })
+        if context == "image_set":
+            if entity.data['series']['date']: 
+                series_date = datetime.strptime(
+                    entity.data['series']['date'],
+                    '%Y-%m-%d'
+                )
+                image_age = (series_date - extra).days//364.2425
+                yield (entity, {
+                    "*NHS - Approx. age at imaging [years]": image_age
+                })
+            return
+
+        del_info = extra
+        equipment = del_info['equipment'] 
+
+        total_fractions = sum(
+            [fg['number_of_fractions_planned'] for fg in del_info['fraction_groups']]
+        ) 
+        beams = del_info['beams']
+
+        technique = " ".join( item for item  in {
+            " ".join([
+                beam['delivery_modality'],
+                beam['radiation_type'],
+                beam['delivery_modality'],
+                f"IMRT: {beam['is_modulated']}",
+                f"Helical: {beam['is_helical']}",
+                ])
+            for beam in beams
+        })
 
-                    try:
-                        prescriptions ="/".join([rx['prescribed_dose'] for rx in
-                        entity.data['prescription']['dose_references'] ])
-                    except KeyError:
-                        prescriptions = "FAILURE"
+        try:
+            prescriptions ="/".join([rx['prescribed_dose'] for rx in
+            entity.data['prescription']['dose_references'] ])
+        except KeyError:
+            prescriptions = "FAILURE"
 
-                    if equipment['device_serial_number']:
-                        sn = equipment['device_serial_number']
-                    else:
-                        sn = "No TDS S/N specified in plan."
+        if equipment['device_serial_number']:
+            sn = equipment['device_serial_number']
+        else:
+            sn = "No TDS S/N specified in plan."
+
+        try:
+            fluence_mode = " ".join([ item for item  in {
+                beam['primary_fluence_mode']['mode'] for beam in beams
+            }])
+        except TypeError:
+            fluence_mode = "FAILURE"
+
+        nominal_beam_energies = list(chain(*[
+            beam['control_point_summary']['nominal_beam_energies'] 
+            for beam in beams
+        ])) 
+        mean_beam_energy = sum(nominal_beam_energies)/len(nominal_beam_energies)
+
+        yield (entity, {
+            "*NHS - TPS Vendor": equipment['manufacturer'],
+            "*NHS - TPS": equipment['manufacturer_model_name'], 
+            "*NHS - TDS S/N": sn, 
+            "*NHS - #Fractions": total_fractions,
+            "*NHS - Modality": technique,
+            "*NHS - Fluence Mode": fluence_mode,
+            "*NHS - MeanBeamEnergy": mean_beam_energy,
+            "*NHS - Prescriptions [Gy]": prescriptions
+        })
+
+    def _write_metadata(self, item):
+        '''
+        Pipeline stage 4: merges meta into the entity metadata and saves. 
+        '''
+        entity, meta = item
+        meta = {**entity.get_metadata(), **meta}
+        entity.set_metadata(meta)
+        entity.save()
+        return ()
+
+    def write_all_custom_metrics(self, fetch_workers: int = 4, 
+        compute_workers: int = 1, write_workers: int = 4, 
+        queue_size: int = 32):
+        '''
+            Params: 
+                fetch_workers: int 
+                    threads fetching patients, entities and delivery info 
+                compute_workers: int 
+                    threads computing custom metric values 
+                write_workers: int 
+                    threads writing entity metadata back to ProKnow 
+                queue_size: int 
+                    maximum number of items waiting between two stages 
+        '''
+
+        print(
+            "Writing *NHSCustomMetrics for patients in "
+            f"{self.collection}."
+            )
+
+        bar_lock = Lock()
+        with ChargingBar('Processing Patients: ', 
+        max=len(self.collection_patients)) as bar:
+            self.pipeline = NHSPipeline(
+                [
+                    ("Enumerate", self._enumerate_patients, 1),
+                    ("Fetch", 
+                        partial(self._fetch_entities, bar=bar, bar_lock=bar_lock),
+                        fetch_workers, self._describe_patient),
+                    ("Compute", self._compute_metrics, compute_workers,
+                        lambda item: self._describe_entity(item[1])),
+                    ("Write", self._write_metadata, write_workers,
+                        lambda item: self._describe_entity(item[0])),
+                ],
+                queue_size = queue_size,
+                log_lines = self.log_lines
+            )
+            self.pipeline.run()
 
-                    try:
-                        fluence_mode = " ".join([ item for item  in {
-                            beam['primary_fluence_mode']['mode'] for beam in beams
-                        }])
-                    except TypeError:
-                        fluence_mode = "FAILURE"
-
-                    nominal_beam_energies = list(chain(*[
-                        beam['control_point_summary']['nominal_beam_energies'] 
-                        for beam in beams
-                    ])) 
-                    mean_beam_energy = sum(nominal_beam_energies)/len(nominal_beam_energies)
-
-                    meta = {
-                        "*NHS - TPS Vendor": equipment['manufacturer'],
-                        "*NHS - TPS": equipment['manufacturer_model_name'], 
-                        "*NHS - TDS S/N": sn, 
-                        "*NHS - #Fractions": total_fractions,
-                        "*NHS - Modality": technique,
-                        "*NHS - Fluence Mode": fluence_mode,
-                        "*NHS - MeanBeamEnergy": mean_beam_energy,
-                        "*NHS - Prescriptions [Gy]": prescriptions
-                    }
-
-                    meta = {**entity.get_metadata(), **meta}
-                    entity.set_metadata(meta)
-                    entity.save()
-                
-                bar.next()
         print("Done!")
+        for line in self.pipeline.report():
+            print(line)
+            self.log_lines.append(line)
+        self.write_logs()
+
 
-    
-    
 class NHSGetEntityDescriptions(NHSProKnow): 
     '''
     Script object template for getting a csv file of all entities 